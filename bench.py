@@ -0,0 +1,274 @@
+"""Benchmark the b.py upload pipeline on synthetic ZIP archives
+
+Every run pushes to a local bare repository, so nothing leaves the machine. Each run also
+gets its own process, so its peak RSS is not inherited from earlier runs.
+
+    python bench.py                               # all shapes, all configs
+    python bench.py --shapes tiny,wrapped --scale 0.5
+    python bench.py --compare bench_results/<old>.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import zipfile
+import argparse
+import platform
+import tempfile
+import subprocess
+import contextlib
+
+import b
+
+RESULTS_DIR = "bench_results"
+CHUNK = 1024 * 1024
+
+# Pipeline configurations run against every shape
+CONFIGS = {
+    "extract-porcelain": dict(mode="extract", backend="porcelain"),
+    "extract-fast-import": dict(mode="extract", backend="fast-import"),
+    "stream": dict(mode="stream", backend="fast-import"),
+}
+
+WORDS = ("const let var function return import export from class async await "
+         "if else for while try catch new this null true false").split()
+
+
+def text_blob(rng, size):
+    """Source-like text of roughly `size` bytes"""
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words).encode('utf-8')[:size]
+
+
+def write_member(zf, name, size, rng, binary=False):
+    """Add one member, streaming large content in chunks"""
+    with zf.open(name, 'w', force_zip64=size > 0x7FFFFFFF) as dst:
+        remaining = size
+        while remaining > 0:
+            n = min(CHUNK, remaining)
+            if binary:
+                # Half random, half zeros: a middling compression ratio without a slow generator
+                dst.write(rng.randbytes(n // 2) + bytes(n - n // 2))
+            else:
+                dst.write(text_blob(rng, n))
+            remaining -= n
+
+
+def shape_tiny(zf, rng, scale):
+    """Many tiny files spread over a shallow tree"""
+    for i in range(int(5000 * scale)):
+        write_member(zf, f"pkg{i % 50}/mod{i // 50}/file{i}.js", rng.randint(10, 600), rng)
+
+
+def shape_huge(zf, rng, scale):
+    """A handful of very large files"""
+    for i in range(3):
+        write_member(zf, f"assets/blob{i}.bin", int(32 * CHUNK * scale), rng, binary=True)
+    write_member(zf, "README.md", 200, rng)
+
+
+def shape_deep(zf, rng, scale):
+    """Deeply nested directories with a few files at every level"""
+    for branch in range(max(1, int(10 * scale))):
+        path = f"deep{branch}"
+        for depth in range(60):
+            path += f"/level{depth}"
+            for i in range(3):
+                write_member(zf, f"{path}/f{i}.txt", rng.randint(50, 4000), rng)
+
+
+def shape_wrapped(zf, rng, scale):
+    """A typical project exported inside a single wrapping root folder"""
+    root = "my-project-main"
+    for folder in ("src", "lib", "components", "pages", "public", "docs"):
+        for i in range(int(400 * scale)):
+            write_member(zf, f"{root}/{folder}/sub{i % 8}/item{i}.js", rng.randint(200, 20000), rng)
+    write_member(zf, f"{root}/package.json", 400, rng)
+    write_member(zf, f"{root}/.gitignore", 50, rng)
+
+
+SHAPES = {
+    "tiny": shape_tiny,
+    "huge": shape_huge,
+    "deep": shape_deep,
+    "wrapped": shape_wrapped,
+}
+
+
+def build_zip(path, shape, scale, seed):
+    """Generate a deterministic synthetic archive for `shape`"""
+    rng = random.Random(f"{shape}:{seed}")
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+        SHAPES[shape](zf, rng, scale)
+    with zipfile.ZipFile(path) as zf:
+        infos = zf.infolist()
+    return {
+        'entries': len(infos),
+        'uncompressed_bytes': sum(info.file_size for info in infos),
+        'zip_bytes': os.path.getsize(path),
+    }
+
+
+def run_upload(work_dir, zip_path, config, blob_cache, object_pool, verbose):
+    """Run one full GitUploader pipeline against a fresh bare repository"""
+    remote = os.path.join(work_dir, "remote.git")
+    subprocess.run(["git", "init", "-q", "--bare", remote], check=True)
+    uploader = b.GitUploader(zip_file=zip_path, repo_name="bench", extract_dir=os.path.join(work_dir, "repo"),
+                             mirror_dir=os.path.join(work_dir, "mirror"), blob_cache=blob_cache,
+                             object_pool=object_pool, remote_url=remote, **CONFIGS[config])
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.nullcontext() if verbose else contextlib.redirect_stdout(devnull):
+            success = uploader.run()
+    wall = time.perf_counter() - start
+    return {
+        'success': bool(success),
+        'error': None if success else uploader.last_error,
+        'wall_s': round(wall, 4),
+        'files': uploader.total_files,
+        'stages': uploader.stage_metrics,
+    }
+
+
+def run_isolated(work_dir, zip_path, config, blob_cache, object_pool, verbose):
+    """run_upload in a fresh interpreter, so peak RSS (a process-lifetime high-water mark) is this run's own"""
+    result_path = os.path.join(work_dir, "result.json")
+    spec = dict(work_dir=work_dir, zip_path=zip_path, config=config, blob_cache=blob_cache,
+                object_pool=object_pool, verbose=verbose, result_path=result_path)
+    subprocess.run([sys.executable, os.path.abspath(__file__), "--run-one", json.dumps(spec)],
+                   stdout=None if verbose else subprocess.DEVNULL, check=True)
+    with open(result_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def run_one(spec):
+    """Child side of run_isolated"""
+    spec = json.loads(spec)
+    result_path = spec.pop('result_path')
+    result = run_upload(**spec)
+    with open(result_path, 'w', encoding='utf-8') as f:
+        json.dump(result, f)
+    return 0
+
+
+def git_revision():
+    """Commit of the b.py checkout being measured"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=here, capture_output=True, text=True)
+    dirty = subprocess.run(["git", "status", "--porcelain", "--", "b.py"], cwd=here, capture_output=True, text=True)
+    revision = result.stdout.strip() or "unknown"
+    return revision + ("-dirty" if dirty.stdout.strip() else "")
+
+
+def compare(current, baseline_path):
+    """Print total and per-stage wall-time deltas against an earlier results file"""
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    old = {(r['shape'], r['config']): r for r in baseline['results']}
+    print(f"\n📈 Compared with {baseline.get('revision')} ({baseline_path})")
+    for result in current['results']:
+        before = old.get((result['shape'], result['config']))
+        if before is None or not before['success'] or not result['success']:
+            continue
+        change = (result['wall_s'] - before['wall_s']) / before['wall_s'] * 100 if before['wall_s'] else 0.0
+        print(f"  {result['shape']:>8} {result['config']:<20} {before['wall_s']:8.2f}s -> {result['wall_s']:8.2f}s "
+              f"({change:+.1f}%)")
+        old_stages = {s['stage']: s for s in before['stages']}
+        for stage in result['stages']:
+            previous = old_stages.get(stage['stage'])
+            if previous is not None:
+                print(f"      {stage['stage']:<14} {previous['wall_s']:8.2f}s -> {stage['wall_s']:8.2f}s")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the b.py upload pipeline")
+    parser.add_argument("--shapes", default=",".join(SHAPES),
+                        help=f"comma separated archive shapes ({', '.join(SHAPES)})")
+    parser.add_argument("--configs", default=",".join(CONFIGS),
+                        help=f"comma separated pipeline configs ({', '.join(CONFIGS)})")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply every shape's file count / size")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per shape and config")
+    parser.add_argument("--seed", type=int, default=0, help="synthetic content seed")
+    parser.add_argument("--blob-cache", action="store_true",
+                        help="share one blob cache and object pool across runs (measures warm uploads)")
+    parser.add_argument("--output", metavar="PATH",
+                        help=f"results file (default: {RESULTS_DIR}/<revision>-<time>.json)")
+    parser.add_argument("--compare", metavar="PATH", help="earlier results file to diff against")
+    parser.add_argument("--work-dir", metavar="PATH", help="keep archives and repositories here")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show uploader logs")
+    parser.add_argument("--run-one", metavar="SPEC", help=argparse.SUPPRESS)  # Internal: one isolated run
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.run_one:
+        return run_one(args.run_one)
+    shapes = [s for s in args.shapes.split(",") if s]
+    configs = [c for c in args.configs.split(",") if c]
+    for name in shapes + configs:
+        if name not in SHAPES and name not in CONFIGS:
+            sys.exit(f"unknown shape/config: {name}")
+
+    root = os.path.abspath(args.work_dir) if args.work_dir else tempfile.mkdtemp(prefix="b-bench-")
+    os.makedirs(root, exist_ok=True)
+    # Keep the uploader's global git config edits away from the real one
+    os.environ["HOME"] = os.path.join(root, "home")
+    os.makedirs(os.environ["HOME"], exist_ok=True)
+    blob_cache = os.path.join(root, "blob-cache.sqlite") if args.blob_cache else ""
+    object_pool = os.path.join(root, "object-pool.git") if args.blob_cache else ""
+
+    report = {
+        'revision': git_revision(),
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'scale': args.scale,
+        'seed': args.seed,
+        'blob_cache': args.blob_cache,
+        'isolated': True,  # One process per run: peak_rss_bytes no longer carries over between configs
+        'results': [],
+    }
+    try:
+        for shape in shapes:
+            zip_path = os.path.join(root, f"{shape}.zip")
+            print(f"📦 Generating '{shape}' archive...")
+            archive = build_zip(zip_path, shape, args.scale, args.seed)
+            for config in configs:
+                for run in range(args.repeat):
+                    work_dir = os.path.join(root, f"{shape}-{config}-{run}")
+                    shutil.rmtree(work_dir, ignore_errors=True)
+                    os.makedirs(work_dir)
+                    result = run_isolated(work_dir, zip_path, config, blob_cache, object_pool, args.verbose)
+                    result.update(shape=shape, config=config, run=run, archive=archive)
+                    report['results'].append(result)
+                    status = "✅" if result['success'] else f"❌ {result['error']}"
+                    stages = "  ".join(f"{s['stage']}={s['wall_s']:.2f}s" for s in result['stages'])
+                    print(f"  {config:<20} {result['wall_s']:8.2f}s {status}\n      {stages}")
+                    if not args.work_dir:
+                        shutil.rmtree(work_dir, ignore_errors=True)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(root, ignore_errors=True)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{report['revision']}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"📄 Results written to {output}")
+
+    if args.compare:
+        compare(report, args.compare)
+    return 0 if all(r['success'] for r in report['results']) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
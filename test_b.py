@@ -0,0 +1,762 @@
+"""End-to-end checks of the b.py upload pipeline against local bare repositories
+
+    python -m pytest -q test_b.py
+"""
+import os
+import io
+import re
+import json
+import shutil
+import struct
+import zipfile
+import zlib
+import tempfile
+import unittest
+import subprocess
+import contextlib
+from unittest import mock
+
+import b
+
+PIPELINES = {
+    "extract-porcelain": dict(mode="extract", backend="porcelain"),
+    "extract-fast-import": dict(mode="extract", backend="fast-import"),
+    "stream": dict(mode="stream", backend="fast-import"),
+}
+
+
+class UploadTestCase(unittest.TestCase):
+    """Each test gets its own scratch directory and HOME (the uploader edits global git config)"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="b-test-")
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        patcher = mock.patch.dict(os.environ, {"HOME": os.path.join(self.root, "home")})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        os.makedirs(os.environ["HOME"])
+
+    def git_lfs(self, installed):
+        """Put a git-lfs stand-in first on PATH: one that accepts every command, or one that fails"""
+        bin_dir = os.path.join(self.root, "bin")
+        os.makedirs(bin_dir, exist_ok=True)
+        script = os.path.join(bin_dir, "git-lfs")
+        with open(script, 'w', encoding='utf-8') as f:
+            f.write(f"#!/bin/sh\nexit {0 if installed else 1}\n")
+        os.chmod(script, 0o755)
+        patcher = mock.patch.dict(os.environ, {"PATH": bin_dir + os.pathsep + os.environ["PATH"]})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_zip(self, members):
+        """Write {name: text} to a fresh archive"""
+        path = os.path.join(self.root, "input.zip")
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for name, text in members.items():
+                zf.writestr(name, text)
+        return path
+
+    def upload(self, zip_path, pipeline, run="", **options):
+        """Run one upload to a fresh remote and return the pushed tree as {path: content}"""
+        work = os.path.join(self.root, pipeline + run)
+        remote = os.path.join(work, "remote.git")
+        subprocess.run(["git", "init", "-q", "--bare", remote], check=True)
+        # Keep pushed packs as sent, so their size can be compared
+        subprocess.run(["git", "config", "receive.unpackLimit", "1"], cwd=remote, check=True)
+        options = dict(PIPELINES[pipeline], **options)
+        uploader = b.GitUploader(zip_file=zip_path, repo_name="test", extract_dir=os.path.join(work, "repo"),
+                                 mirror_dir=os.path.join(work, "mirror"), remote_url=remote, **options)
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertTrue(uploader.run(), uploader.last_error)
+        self.output = output.getvalue()
+        listing = subprocess.run(["git", "ls-tree", "-r", "-z", "--name-only", "main"], cwd=remote,
+                                 capture_output=True, text=True, check=True).stdout
+        return {path: subprocess.run(["git", "show", f"main:{path}"], cwd=remote, capture_output=True,
+                                     check=True).stdout
+                for path in listing.split('\0') if path}
+
+    def pack_bytes(self, pipeline, run=""):
+        """Size of the packs pushed by upload(zip_path, pipeline, run)"""
+        pack_dir = os.path.join(self.root, pipeline + run, "remote.git", "objects", "pack")
+        return sum(os.path.getsize(os.path.join(pack_dir, name)) for name in os.listdir(pack_dir)
+                   if name.endswith(".pack"))
+
+    def run_main(self, *argv):
+        """Run the command line entry point from the scratch directory; stdout is kept in self.output"""
+        # Relative defaults (batch and extract directories) land in the scratch directory
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.root)
+        with contextlib.redirect_stdout(io.StringIO()) as output, contextlib.redirect_stderr(io.StringIO()):
+            status = b.main(list(argv))
+        self.output = output.getvalue()
+        return status
+
+    def assertTreesEqual(self, zip_path, expected=None, pipelines=tuple(PIPELINES)):
+        """Every pipeline pushes the same tree (and `expected` paths, when given)"""
+        trees = {pipeline: self.upload(zip_path, pipeline) for pipeline in pipelines}
+        reference = trees["extract-porcelain"]
+        for pipeline, tree in trees.items():
+            self.assertEqual(sorted(tree), sorted(reference), pipeline)
+            self.assertEqual(tree, reference, pipeline)
+        if expected is not None:
+            self.assertEqual(sorted(reference), sorted(expected))
+        return reference
+
+
+class NormalizationTest(UploadTestCase):
+    def test_root_dotfiles_keep_wrapping_folder(self):
+        # A root .env / .gitignore next to the wrapper means there is no single root folder to strip
+        zip_path = self.make_zip({
+            ".env": "SECRET=1\n",
+            ".gitignore": "*.log\n",
+            "ab/src/main.js": "x = 1\n",
+            "ab/lib/main.js": "y = 2\n",
+            "ab/app/main.js": "z = 3\n",
+            "ab/README.md": "hi\n",
+        })
+        # Tree pushed by the original (pre-index) uploader for this archive
+        tree = self.assertTreesEqual(zip_path, [".env", ".gitignore", "ab/README.md", "ab/app/main.js",
+                                                "ab/lib/main.js", "ab/src/main.js"])
+        self.assertEqual(tree[".env"], b"SECRET=1\n")
+        self.assertEqual(tree[".gitignore"], b.SMART_GITIGNORE.encode('utf-8'))
+
+    def test_wrapping_folder_is_stripped(self):
+        zip_path = self.make_zip({f"proj/{folder}/index.js": folder for folder in ("src", "lib", "app")})
+        self.assertTreesEqual(zip_path, [".gitignore", "app/index.js", "lib/index.js", "src/index.js"])
+
+
+class IgnoreTest(UploadTestCase):
+    # Stream and fused extract+fast-import decide ignores from the archive; porcelain lets git see the files
+    def test_nested_gitignore_applies_in_every_pipeline(self):
+        zip_path = self.make_zip({
+            "README.md": "readme\n",
+            "app/.gitignore": "local.cfg\n",
+            "app/local.cfg": "password\n",
+            "app/main.js": "main()\n",
+            "node_modules/pkg/index.js": "module.exports = 1\n",
+        })
+        self.assertTreesEqual(zip_path, [".gitignore", "README.md", "app/.gitignore", "app/main.js"])
+
+    def test_nested_negation_reincludes_path(self):
+        # The smart .gitignore drops *.log; a nested rule brings one back
+        zip_path = self.make_zip({
+            "README.md": "readme\n",
+            "logs/.gitignore": "!keep.log\n",
+            "logs/keep.log": "kept\n",
+            "logs/debug.log": "dropped\n",
+        })
+        self.assertTreesEqual(zip_path, [".gitignore", "README.md", "logs/.gitignore", "logs/keep.log"])
+
+
+class CentralDirectoryTest(UploadTestCase):
+    def records(self, path):
+        with open(path, 'rb') as f:
+            return list(b.read_central_directory(f))
+
+    def zipfile_records(self, path):
+        with zipfile.ZipFile(path) as zf:
+            return [(info.filename, info.file_size, info.compress_size, info.CRC, info.compress_type, info.flag_bits,
+                     info.header_offset) for info in zf.infolist()]
+
+    def zip64_archive(self, members, prefix=b""):
+        """Hand-built archive whose central directory uses ZIP64 fields for every size and offset"""
+        local, central = b"", b""
+        for name, data in members.items():
+            raw, crc, offset = name.encode('utf-8'), zipfile.crc32(data), len(local)
+            local += struct.pack(zipfile.structFileHeader, zipfile.stringFileHeader, 45, 0, 0x800, 0, 0, 0x21,
+                                 crc, len(data), len(data), len(raw), 0) + raw + data
+            extra = struct.pack('<HH3Q', 1, 24, len(data), len(data), offset)
+            central += struct.pack(zipfile.structCentralDir, zipfile.stringCentralDir, 45, 3, 45, 0, 0x800, 0, 0,
+                                   0x21, crc, 0xFFFFFFFF, 0xFFFFFFFF, len(raw), len(extra), 0, 0, 0, 0,
+                                   0xFFFFFFFF) + raw + extra
+        end64 = struct.pack(zipfile.structEndArchive64, zipfile.stringEndArchive64, 44, 45, 45, 0, 0,
+                            len(members), len(members), len(central), len(local))
+        locator = struct.pack(zipfile.structEndArchive64Locator, zipfile.stringEndArchive64Locator, 0,
+                              len(local) + len(central), 1)
+        end = struct.pack(zipfile.structEndArchive, zipfile.stringEndArchive, 0, 0, 0xFFFF, 0xFFFF,
+                          0xFFFFFFFF, 0xFFFFFFFF, 0)
+        path = os.path.join(self.root, "zip64.zip")
+        with open(path, 'wb') as f:
+            f.write(prefix + local + central + end64 + locator + end)
+        return path
+
+    def test_archive_comment(self):
+        path = self.make_zip({"a.txt": "a\n", "dir/b.txt": "b" * 500})
+        expected = self.zipfile_records(path)
+        with zipfile.ZipFile(path, 'a') as zf:
+            zf.comment = b"release notes " * 1000
+        self.assertEqual(self.records(path), expected)
+        # zipfile gives up when the comment contains the end record signature; the index does not
+        with zipfile.ZipFile(path, 'a') as zf:
+            zf.comment = b"PK\x05\x06 is not a record " * 100
+        self.assertEqual(self.records(path), expected)
+
+    def test_prepended_data(self):
+        # Self-extracting archives start with a stub; every offset shifts by its length
+        plain = self.make_zip({"a.txt": "a\n", "dir/b.txt": "b" * 500})
+        path = os.path.join(self.root, "sfx.zip")
+        with open(plain, 'rb') as src, open(path, 'wb') as dst:
+            dst.write(b"#!/bin/sh\nexit 0\n" + b"\0" * 1000 + src.read())
+        records = self.records(path)
+        self.assertEqual(records, self.zipfile_records(path))
+        self.assertEqual(records[0][-1], 1017)
+
+    def test_zip64_fields(self):
+        members = {"a.txt": b"alpha\n", "dir/b.txt": b"beta" * 100}
+        for prefix in (b"", b"stub" * 10):
+            with self.subTest(prefix=len(prefix)):
+                path = self.zip64_archive(members, prefix)
+                records = self.records(path)
+                self.assertEqual(records, self.zipfile_records(path))
+                self.assertEqual([(name, size) for name, size, *_ in records], [("a.txt", 6), ("dir/b.txt", 400)])
+                # The members read back through the index and the memory map
+                reader = b.ZipReader(path)
+                self.addCleanup(reader.close)
+                for entry in b.ZipIndex(path).scan().iter_files():
+                    with reader.open(entry) as src:
+                        self.assertEqual(bytes(src.read()), members[entry.name])
+
+
+class MemberReaderTest(UploadTestCase):
+    DATA = b"".join(b"line %d of the member\n" % i for i in range(20000))
+
+    def reader(self, stored, method, crc=None, size=None):
+        entry = b.ZipEntry("m.txt", len(self.DATA) if size is None else size, len(stored),
+                           zlib.crc32(self.DATA) if crc is None else crc, method, 0, 0, False, True)
+        return b.MemberReader(memoryview(stored), entry)
+
+    def deflated(self):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compressor.compress(self.DATA) + compressor.flush()
+
+    def read_all(self, reader, size=4096):
+        return b"".join(bytes(chunk) for chunk in iter(lambda: reader.read(size), b""))
+
+    def test_stored_reads_are_views_of_the_map(self):
+        reader = self.reader(self.DATA, zipfile.ZIP_STORED)
+        self.assertIsInstance(reader.read(100), memoryview)
+        self.assertEqual(b"".join([self.DATA[:100], self.read_all(reader)]), self.DATA)
+
+    def test_deflated_reads_respect_size(self):
+        reader = self.reader(self.deflated(), zipfile.ZIP_DEFLATED)
+        chunks = list(iter(lambda: reader.read(1000), b""))
+        self.assertTrue(all(len(chunk) <= 1000 for chunk in chunks))
+        self.assertEqual(b"".join(chunks), self.DATA)
+        self.assertEqual(self.reader(self.deflated(), zipfile.ZIP_DEFLATED).read(), self.DATA)
+
+    def test_bad_crc(self):
+        for method, stored in ((zipfile.ZIP_STORED, self.DATA), (zipfile.ZIP_DEFLATED, self.deflated())):
+            with self.subTest(method=method):
+                reader = self.reader(stored, method, crc=zlib.crc32(self.DATA) ^ 1)
+                with self.assertRaisesRegex(zipfile.BadZipFile, "Bad CRC-32"):
+                    self.read_all(reader)
+
+    def test_truncated_deflate_stream(self):
+        reader = self.reader(self.deflated()[:1000], zipfile.ZIP_DEFLATED)
+        with self.assertRaisesRegex(zipfile.BadZipFile, "Truncated"):
+            self.read_all(reader)
+
+    def test_short_stored_member(self):
+        # Fewer stored bytes than the declared size must fail, not end early
+        reader = self.reader(self.DATA[:-10], zipfile.ZIP_STORED)
+        with self.assertRaisesRegex(zipfile.BadZipFile, "Truncated data"):
+            self.read_all(reader)
+
+    def test_truncated_archive(self):
+        path = self.make_zip({"a.txt": "a" * 5000, "b.txt": os.urandom(5000).hex()})
+        with zipfile.ZipFile(path) as zf:
+            info = zf.getinfo("b.txt")
+        entry = b.ZipEntry("b.txt", info.file_size, info.compress_size + 10 ** 6, info.CRC, info.compress_type, 0,
+                           info.header_offset, False, True)
+        reader = b.ZipReader(path)
+        self.addCleanup(reader.close)
+        with self.assertRaisesRegex(zipfile.BadZipFile, "Truncated data"):
+            reader.open(entry)
+
+
+class PlanTest(UploadTestCase):
+    RATE = (1.5, 0.002, 0.25)  # Fixed seconds, seconds per file, seconds per MB
+
+    def seconds(self, files, mb):
+        return self.RATE[0] + self.RATE[1] * files + self.RATE[2] * mb
+
+    def test_fit_recovers_linear_rate(self):
+        samples = [(files, mb, self.seconds(files, mb)) for files, mb in ((100, 1), (5000, 2), (200, 80), (9000, 40))]
+        for fitted, expected in zip(b.fit_stage_rate(samples), self.RATE):
+            self.assertAlmostEqual(fitted, expected, places=6)
+
+    def test_fit_is_never_negative(self):
+        self.assertIsNone(b.fit_stage_rate([]))
+        # One archive shape only: the terms cannot be told apart, but the prediction still fits it
+        rate = b.fit_stage_rate([(1000, 10, 4.0), (1000, 10, 6.0)])
+        self.assertTrue(all(value >= 0 for value in rate))
+        self.assertAlmostEqual(rate[0] + rate[1] * 1000 + rate[2] * 10, 5.0, places=6)
+        # Bigger archives that happened to run faster must not produce a negative rate
+        rate = b.fit_stage_rate([(10, 1, 9.0), (10000, 100, 1.0), (500, 50, 5.0)])
+        self.assertTrue(all(value >= 0 for value in rate))
+
+    def test_plan_json(self):
+        history = os.path.join(self.root, "history")
+        os.makedirs(history)
+        results = [{'config': "stream", 'success': True,
+                    'archive': {'entries': files, 'uncompressed_bytes': mb * 2 ** 20},
+                    'stages': [{'stage': "stream", 'wall_s': self.seconds(files, mb)}]}
+                   for files, mb in ((100, 1), (5000, 2), (200, 80))]
+        with open(os.path.join(history, "bench.json"), 'w', encoding='utf-8') as f:
+            json.dump({'results': results}, f)
+        # Warm-cache runs predict too little work and are left out
+        with open(os.path.join(history, "warm.json"), 'w', encoding='utf-8') as f:
+            json.dump({'blob_cache': True, 'results': [dict(results[0], stages=[{'stage': "stream", 'wall_s': 0}])]}, f)
+        
+        members = {f"proj/src/f{i}.js": f"f{i}\n" for i in range(6)}
+        members.update({"proj/src/copy.js": "f0\n", "proj/node_modules/x/index.js": "x\n",
+                        "proj/big.bin": os.urandom(70000).hex()})
+        zip_path = self.make_zip(members)
+        with open(os.path.join(self.root, "jobs.jsonl"), 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'zip': zip_path, 'repo': "planned"}) + "\n")
+        status = self.run_main("--manifest", "jobs.jsonl", "--plan", "plan.json", "--plan-history", history,
+                               "--mode", "stream", "--lfs-threshold", "0.1")
+        self.assertEqual(status, 0)
+        with open(os.path.join(self.root, "plan.json"), encoding='utf-8') as f:
+            plan, = json.load(f)['jobs']
+        
+        self.assertEqual(plan['strip_prefix'], "proj/")
+        files = plan['files']
+        self.assertEqual((files['written'], files['ignored'], files['lfs'], files['duplicates']), (8, 1, 1, 1))
+        self.assertEqual(files['lfs_bytes'], 140000)
+        self.assertEqual(plan['history'], {'config': "stream", 'runs': 3})
+        written_mb = files['written_bytes'] / 2 ** 20
+        self.assertAlmostEqual(plan['stages']['stream'], self.seconds(8, written_mb), places=2)
+        self.assertTrue(plan['accepted'])
+        # The plan counts what an upload then writes (plus the generated .gitignore and .gitattributes)
+        self.git_lfs(installed=True)
+        tree = self.upload(zip_path, "stream", lfs_threshold=100000)
+        self.assertEqual(len(tree), files['written'] + 2)
+
+
+class IgnoreMatcherTest(UploadTestCase):
+    RULES = b.SMART_GITIGNORE + "\n".join([
+        "/build", "docs/*.tmp", "**/cache/", "a?c.txt", "[ab].log", "[!x]y.cfg", "\\#notes", "out/**/gen",
+        "trailing/", "*.swp", "deep/**",
+    ]) + "\n"
+    PATHS = [
+        "build", "build/app.js", "src/build", "src/build/x.js", "docs/a.tmp", "docs/sub/a.tmp", "x/docs/a.tmp",
+        "cache/x", "src/cache/y", "src/cache", "abc.txt", "a/c.txt", "abbc.txt", "a.log", "c.log", "zy.cfg",
+        "xy.cfg", "#notes", "notes", "out/gen", "out/a/b/gen", "out/gen/file", "trailing", "trailing/file",
+        "lib/trailing", ".a.swp", "deep/a/b", "deep", "src/deep/a", "node_modules/pkg/index.js",
+        "src/node_modules/x.js", "app.log", "logs/x/y.txt", ".env", ".env.local", "dist/main.js", "README.md",
+        "src/main.py", "src/__pycache__/m.pyc", ".DS_Store", "sub/.DS_Store", "Thumbs.db", "coverage/index.html",
+    ]
+
+    def git_ignored(self, paths):
+        repo = os.path.join(self.root, "ignore-repo")
+        subprocess.run(["git", "init", "-q", repo], check=True)
+        with open(os.path.join(repo, ".gitignore"), 'w', encoding='utf-8') as f:
+            f.write(self.RULES)
+        result = subprocess.run(["git", "check-ignore", "--no-index", "--stdin", "-z"], cwd=repo, capture_output=True,
+                                input="\0".join(paths).encode('utf-8') + b"\0")
+        return {path for path in result.stdout.decode('utf-8').split('\0') if path}
+
+    def test_matches_git_check_ignore(self):
+        matcher = b.IgnoreMatcher(self.RULES)
+        self.assertFalse(matcher.negated)
+        expected = self.git_ignored(self.PATHS)
+        self.assertTrue(expected)
+        self.assertEqual({path for path in self.PATHS if matcher.ignored(path)}, expected)
+
+    def test_negation_is_left_to_git(self):
+        self.assertTrue(b.IgnoreMatcher("*.log\n!keep.log\n").negated)
+
+
+class CorruptMemberTest(UploadTestCase):
+    # A member that cannot be read is reported and left out; the rest of the archive is still pushed
+    def corrupt(self, zip_path, name, offset, data):
+        """Overwrite bytes of member `name`, `offset` counted from its local header"""
+        with zipfile.ZipFile(zip_path) as zf:
+            info = zf.getinfo(name)
+        with open(zip_path, 'r+b') as f:
+            f.seek(info.header_offset + offset)
+            f.write(data)
+
+    def make_archive(self):
+        path = os.path.join(self.root, "input.zip")
+        with zipfile.ZipFile(path, 'w') as zf:
+            zf.writestr("README.md", "readme\n", zipfile.ZIP_DEFLATED)
+            zf.writestr("src/bad.js", "x = 1\n" * 100, zipfile.ZIP_STORED)
+            zf.writestr("src/good.js", "y = 2\n", zipfile.ZIP_DEFLATED)
+        return path
+
+    def test_bad_local_header_is_skipped(self):
+        zip_path = self.make_archive()
+        self.corrupt(zip_path, "src/bad.js", 0, b"XXXX")
+        self.assertTreesEqual(zip_path, [".gitignore", "README.md", "src/good.js"])
+        self.assertIn("src/bad.js", self.output)
+
+    def test_bad_crc_is_skipped(self):
+        zip_path = self.make_archive()
+        self.corrupt(zip_path, "src/bad.js", zipfile.sizeFileHeader + len("src/bad.js"), b"z")
+        self.assertTreesEqual(zip_path, [".gitignore", "README.md", "src/good.js"])
+        self.assertNotIn("could not write all blobs", self.output)
+
+
+def forge_crc(data, crc):
+    """`data` with its last 4 bytes changed so that its CRC32 is `crc` (CRC32 is affine over GF(2))"""
+    data = bytearray(data[:-4] + bytes(4))
+    base = zlib.crc32(data)
+    columns = []  # CRC change from flipping each of the last 32 bits
+    for bit in range(32):
+        flipped = bytearray(data)
+        flipped[len(data) - 4 + bit // 8] ^= 1 << bit % 8
+        columns.append(zlib.crc32(flipped) ^ base)
+    rows = [(columns[bit], 1 << bit) for bit in range(32)]  # Gaussian elimination on (change, bits)
+    solution, target = 0, crc ^ base
+    for pivot in range(31, -1, -1):
+        row = next(((change, bits) for change, bits in rows if change >> pivot & 1), None)
+        if row is None:
+            continue
+        rows = [(change ^ row[0], bits ^ row[1]) if change >> pivot & 1 and (change, bits) != row else (change, bits)
+                for change, bits in rows if (change, bits) != row]
+        if target >> pivot & 1:
+            target ^= row[0]
+            solution ^= row[1]
+    data[-4:] = solution.to_bytes(4, 'little')
+    assert zlib.crc32(data) == crc
+    return bytes(data)
+
+
+class DuplicateTest(UploadTestCase):
+    def test_identical_members_share_one_blob(self):
+        shared = b"export const shared = 1;\n" * 50
+        text = b"plain text body, same size as its twin"
+        twin = forge_crc(b"different text, same size as its twin!", zlib.crc32(text))
+        path = os.path.join(self.root, "input.zip")
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr("node_modules/lib/shared.js", shared)  # Ignored: never a primary
+            for name in ("src/a/shared.js", "src/b/shared.js", "src/c/shared.js"):
+                zf.writestr(name, shared)
+            zf.writestr("scripts/shared.js", shared, zipfile.ZIP_STORED)  # Compared as stored bytes: not a duplicate
+            zf.writestr("docs/text.txt", text)
+            zf.writestr("docs/twin.txt", twin)  # Same CRC32 and size, different bytes
+        for pipeline in PIPELINES:
+            with self.subTest(pipeline=pipeline):
+                metrics = b.Metrics()
+                tree = self.upload(path, pipeline, metrics=metrics)
+                self.assertEqual(sorted(tree), [".gitignore", "docs/text.txt", "docs/twin.txt", "scripts/shared.js",
+                                                "src/a/shared.js", "src/b/shared.js", "src/c/shared.js"])
+                self.assertEqual({tree[name] for name in tree if name.endswith("shared.js")}, {shared})
+                self.assertEqual((tree["docs/text.txt"], tree["docs/twin.txt"]), (text, twin))
+                self.assertEqual(metrics.counters[("duplicate_files", ())], 2)
+
+
+class FallbackTest(UploadTestCase):
+    def test_failed_fast_import_falls_back_to_git_add(self):
+        zip_path = self.make_zip({".gitignore": "*.tmp\n", "README.md": "readme\n", "src/main.js": "main()\n",
+                                  "src/cache.tmp": "scratch\n"})
+        reference = self.upload(zip_path, "extract-porcelain")
+        with mock.patch.object(b.FastImportBackend, "write_blobs", return_value=False):
+            tree = self.upload(zip_path, "extract-fast-import")
+        self.assertIn("falling back to git add/commit", self.output)
+        self.assertEqual(tree, reference)
+
+
+class CacheDefaultsTest(UploadTestCase):
+    def test_blob_cache_is_opt_in(self):
+        self.assertEqual(b.parse_args([]).blob_cache, "")
+        self.assertEqual(b.parse_args(["--blob-cache"]).blob_cache, os.path.join(b.CACHE_DIR, "blob_cache.sqlite"))
+
+    def test_object_pool_is_opt_in(self):
+        self.assertEqual(b.parse_args([]).object_pool, "")
+        self.assertEqual(b.parse_args(["--object-pool"]).object_pool, os.path.join(b.CACHE_DIR, "object_pool.git"))
+
+    def test_default_upload_leaves_nothing_behind(self):
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.root)
+        zip_path = self.make_zip({"README.md": "readme\n"})
+        before = set(os.listdir(self.root))
+        self.upload(zip_path, "stream")
+        self.assertEqual(set(os.listdir(self.root)) - before, {"stream"})
+        self.assertEqual(os.listdir(os.environ["HOME"]), [".gitconfig"])
+
+    def test_blob_cache_directory_is_created(self):
+        cache = os.path.join(self.root, "cache", "zip-upload", "blob_cache.sqlite")
+        zip_path = self.make_zip({"README.md": "readme\n"})
+        self.upload(zip_path, "stream", blob_cache=cache)
+        self.assertTrue(os.path.exists(cache))
+
+
+class PackProfileTest(UploadTestCase):
+    def test_profile_shapes_the_pushed_pack_in_every_pipeline(self):
+        # Over fastimport.unpackLimit (100), so fast-import keeps its own pack and push reuses it
+        words = [f"w{i * 7919 % 3001:x}" for i in range(3000)]
+        zip_path = self.make_zip({f"docs/f{i}.txt": " ".join(words[(i * 37 + j * j) % 3000] for j in range(1000))
+                                  for i in range(120)})
+        for pipeline in PIPELINES:
+            with self.subTest(pipeline=pipeline):
+                fast = self.upload(zip_path, pipeline, "-fast", pack_profile="fast")
+                small = self.upload(zip_path, pipeline, "-small", pack_profile="small")
+                self.assertEqual(fast, small)
+                self.assertGreater(self.pack_bytes(pipeline, "-fast"), self.pack_bytes(pipeline, "-small"))
+
+
+class BlobCacheTest(UploadTestCase):
+    def open_cache(self, stamp, max_entries=3):
+        """The cache as a run started at `stamp` sees it"""
+        with mock.patch.object(b.time, "time", return_value=stamp):
+            cache = b.BlobCache(os.path.join(self.root, "cache", "blobs.sqlite"), max_entries)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_least_recently_used_rows_are_evicted(self):
+        key = lambda name: (name, zlib.crc32(name.encode()), len(name), 8)
+        for stamp, name in ((100, "a"), (200, "b"), (300, "c")):
+            self.open_cache(stamp).store([(key(name), name * 40)])
+        # A hit refreshes "a", so the next store evicts "b", the least recently used
+        cache = self.open_cache(400)
+        self.assertEqual(cache.lookup([key("a"), key("x")]), {key("a"): "a" * 40})
+        cache.store([(key("d"), "d" * 40)])
+        cache.close()
+        cache = self.open_cache(500)
+        found = cache.lookup([key(name) for name in "abcd"])
+        self.assertEqual(sorted(name for name, *_ in found), ["a", "c", "d"])
+        # One oversized run keeps only max_entries rows
+        cache.store([(key(f"n{i}"), "e" * 40) for i in range(5)])
+        self.assertEqual(cache.db.execute("SELECT COUNT(*) FROM blobs").fetchone()[0], 3)
+
+    def test_second_upload_reuses_cached_blobs(self):
+        zip_path = self.make_zip({f"src/f{i}.js": f"f({i})\n" for i in range(5)})
+        shared = dict(blob_cache=os.path.join(self.root, "cache.sqlite"),
+                      object_pool=os.path.join(self.root, "pool.git"))
+        for pipeline in PIPELINES:
+            with self.subTest(pipeline=pipeline):
+                cold = self.upload(zip_path, pipeline, "-cold", **shared)
+                warm = self.upload(zip_path, pipeline, "-warm", **shared)
+                self.assertIn("Blob cache: 5 files reused", self.output)
+                self.assertEqual(warm, cold)
+
+    def test_lfs_path_is_not_staged_from_cache(self):
+        # The first run caches the full blob; once routed to LFS the path must be committed as a pointer
+        self.git_lfs(installed=True)
+        zip_path = self.make_zip({"README.md": "readme\n", "assets/big.bin": "x" * 60000})
+        shared = dict(blob_cache=os.path.join(self.root, "cache.sqlite"),
+                      object_pool=os.path.join(self.root, "pool.git"))
+        for pipeline in PIPELINES:
+            with self.subTest(pipeline=pipeline):
+                full = self.upload(zip_path, pipeline, "-full", **shared)
+                self.assertEqual(full["assets/big.bin"], b"x" * 60000)
+                tree = self.upload(zip_path, pipeline, "-lfs", lfs_threshold=50000, **shared)
+                self.assertTrue(tree["assets/big.bin"].startswith(f"version {b.LFS_SPEC}\n".encode('ascii')))
+                self.assertIn(b"assets/big.bin filter=lfs", tree[".gitattributes"])
+
+
+class MetricsTest(UploadTestCase):
+    SAMPLE = re.compile(r'^(zip_upload_[a-z_]+)(\{(?:[a-z_]+="(?:[^"\\]|\\.)*",?)*\})? (\S+)$')
+
+    def prometheus_samples(self, text):
+        """Parse exposition text into [(metric, labels text, value)], checking each family is typed once"""
+        typed, samples = set(), []
+        for line in text.splitlines():
+            if line.startswith("# TYPE "):
+                metric = line.split()[2]
+                self.assertNotIn(metric, typed)
+                typed.add(metric)
+                continue
+            match = self.SAMPLE.match(line)
+            self.assertIsNotNone(match, line)
+            metric, labels, value = match.groups()
+            self.assertTrue(any(metric == family or metric.startswith(family + "_") for family in typed), line)
+            samples.append((metric, labels or "", float(value)))
+        return samples
+
+    def test_upload_exports_consistent_jsonl_and_prometheus(self):
+        zip_path = self.make_zip({f"src/f{i}.js": f"f({i})\n" for i in range(3)})
+        jsonl, prom = os.path.join(self.root, "metrics.jsonl"), os.path.join(self.root, "metrics.prom")
+        for run in ("-1", "-2"):
+            metrics = b.Metrics()
+            self.upload(zip_path, "stream", run, metrics=metrics)
+            metrics.export(jsonl, prom)
+
+        with open(jsonl, encoding='utf-8') as f:
+            records = [json.loads(line) for line in f]
+        summaries = [r for r in records if r['type'] == 'summary']
+        self.assertEqual(len(summaries), 2)  # Appended, one summary per run
+        second = records[records.index(summaries[0]) + 1:]
+        spans = [r for r in second if r['type'] == 'span']
+        self.assertEqual([r['ok'] for r in spans if r['span'] == 'upload'], [True])
+        self.assertTrue(any(r['span'] == 'git_command' for r in spans))
+        counters = {c['name']: c['value'] for c in summaries[-1]['counters'] if not c['labels']}
+        self.assertEqual(counters.get('ignored_files', 0), 0)
+        uploads = [c for c in summaries[-1]['counters'] if c['name'] == 'uploads']
+        self.assertEqual(uploads, [{'name': 'uploads', 'labels': {'result': 'success'}, 'value': 1}])
+
+        with open(prom, encoding='utf-8') as f:
+            samples = self.prometheus_samples(f.read())
+        self.assertFalse([name for name in os.listdir(self.root) if name.endswith(".tmp")])
+        self.assertIn(("zip_upload_uploads_total", '{result="success"}', 1), samples)  # Replaced, not summed
+        histograms = {}
+        for metric, labels, value in samples:
+            if metric.endswith("_bucket"):
+                series = re.sub(r',?le="[^"]*"', "", labels)
+                histograms.setdefault((metric[:-len("_bucket")], series), []).append(value)
+        self.assertIn("zip_upload_upload_seconds", {metric for metric, _ in histograms})
+        for (metric, series), buckets in histograms.items():
+            self.assertEqual(buckets, sorted(buckets), metric)  # Cumulative
+            count = dict(((m, l), v) for m, l, v in samples)[(metric + "_count", series.replace("{}", ""))]
+            self.assertEqual(buckets[-1], count, metric)
+
+    def test_label_values_are_escaped(self):
+        metrics = b.Metrics(buckets=(1,))
+        metrics.inc("git_commands", command='say "hi"\\now\nthen')
+        metrics.observe("stage_seconds", 2, stage="a")
+        metrics.observe("stage_seconds", 0.5, stage="a")
+        text = metrics.prometheus_text()
+        self.assertIn('zip_upload_git_commands_total{command="say \\"hi\\"\\\\now\\nthen"} 1\n', text)
+        self.assertIn('zip_upload_stage_seconds_bucket{stage="a",le="1"} 1\n', text)
+        self.assertIn('zip_upload_stage_seconds_bucket{stage="a",le="+Inf"} 2\n', text)
+        self.assertIn('zip_upload_stage_seconds_sum{stage="a"} 2.500000\n', text)
+        self.prometheus_samples(text)
+
+
+class LfsTest(UploadTestCase):
+    def test_missing_git_lfs_commits_regular_blobs(self):
+        # Pointers whose objects can never be uploaded must not be pushed
+        self.git_lfs(installed=False)
+        zip_path = self.make_zip({"README.md": "readme\n", "assets/big.bin": "x" * 60000})
+        for pipeline in PIPELINES:
+            with self.subTest(pipeline=pipeline):
+                tree = self.upload(zip_path, pipeline, lfs_threshold=50000)
+                self.assertEqual(tree["assets/big.bin"], b"x" * 60000)
+                self.assertNotIn(".gitattributes", tree)
+                self.assertIn("git-lfs is not installed", self.output)
+
+
+class ShardedStagingTest(UploadTestCase):
+    def test_failed_bulk_add_falls_back_to_sharded_hashing(self):
+        repo = os.path.join(self.root, "repo")
+        os.makedirs(os.path.join(repo, "sub"))
+        subprocess.run(["git", "init", "-q", repo], check=True)
+        paths = []
+        for i in range(40):
+            paths.append(f"sub/f{i}.txt")
+            with open(os.path.join(repo, paths[-1]), 'w', encoding='utf-8') as f:
+                f.write(f"x{i}\n")
+        os.chmod(os.path.join(repo, "sub/f3.txt"), 0o755)
+        paths.append("new\nline.txt")
+        with open(os.path.join(repo, paths[-1]), 'w', encoding='utf-8') as f:
+            f.write("nl\n")
+        paths.insert(10, "sub/missing.txt")  # Listed, but gone by the time it is hashed
+
+        uploader = b.GitUploader(zip_file="unused.zip", extract_dir=repo, jobs=3)
+        hashed = []
+        git_output = uploader.git_output
+
+        def spy(cmd, *args, **kwargs):
+            if cmd[1] == "hash-object":
+                hashed.append(cmd[-1])
+            return git_output(cmd, *args, **kwargs)
+
+        with mock.patch.object(b, "STAGE_SHARD_FILES", 7), \
+                mock.patch.object(uploader, "run_git_command", return_value=False), \
+                mock.patch.object(uploader, "git_output", side_effect=spy), \
+                contextlib.redirect_stdout(io.StringIO()) as output:
+            staged = uploader._git_add_files(paths)
+            b.LOGGER.flush()
+        self.assertEqual(staged, 41)
+        self.assertIn("in 7 shard(s)", output.getvalue())
+        self.assertIn("Cannot stage sub/missing.txt", output.getvalue())
+        # 6 shards of up to 7; the one holding the missing file is bisected 7 -> 3 + 4 -> 2 + 2 -> 1 + 1
+        self.assertEqual(hashed.count("--stdin-paths"), 6 + 4)
+        self.assertIn("sub/missing.txt", hashed)
+        self.assertIn("new\nline.txt", hashed)
+
+        def tree():
+            return subprocess.run(["git", "write-tree"], cwd=repo, capture_output=True, text=True,
+                                  check=True).stdout
+        sharded = tree()
+        subprocess.run(["git", "add", "-A"], cwd=repo, check=True)
+        self.assertEqual(sharded, tree())  # Same entries and modes as a bulk add
+
+
+class IncrementalTest(UploadTestCase):
+    def commits(self):
+        remote = os.path.join(self.root, "stream-inc", "remote.git")
+        return subprocess.run(["git", "rev-list", "main"], cwd=remote, capture_output=True, text=True,
+                              check=True).stdout.split()
+
+    def test_modify_delete_and_noop_runs(self):
+        files = {"src/a.js": "a = 1\n", "src/old/b.js": "b = 2\n", "README.md": "readme\n"}
+        first = self.upload(self.make_zip(files), "stream", "-inc", incremental=True)
+        self.assertEqual(sorted(first), [".gitignore", "README.md", "src/a.js", "src/old/b.js"])
+        self.assertEqual(len(self.commits()), 1)
+
+        files = {"src/a.js": "a = 10\n", "src/new.js": "n = 3\n", "README.md": "readme\n"}
+        second = self.upload(self.make_zip(files), "stream", "-inc", incremental=True)
+        self.assertIn("Delta: 2 changed, 1 deleted, 1 unchanged", self.output)
+        self.assertEqual(sorted(second), [".gitignore", "README.md", "src/a.js", "src/new.js"])
+        self.assertEqual((second["src/a.js"], second["src/new.js"]), (b"a = 10\n", b"n = 3\n"))
+        self.assertEqual(second["README.md"], first["README.md"])
+        commits = self.commits()
+        self.assertEqual(len(commits), 2)  # On top of the first, not forced over it
+
+        third = self.upload(self.make_zip(files), "stream", "-inc", incremental=True)
+        self.assertIn("Delta: 0 changed, 0 deleted, 3 unchanged", self.output)
+        self.assertEqual(third, second)
+        self.assertEqual(self.commits(), commits)
+
+        # Someone else rewound the branch: the manifest no longer describes the remote
+        remote = os.path.join(self.root, "stream-inc", "remote.git")
+        subprocess.run(["git", "update-ref", "refs/heads/main", commits[-1]], cwd=remote, check=True)
+        fourth = self.upload(self.make_zip(files), "stream", "-inc", incremental=True)
+        self.assertIn("committing the full tree on top", self.output)
+        self.assertEqual(fourth, second)
+        self.assertEqual(self.commits()[1:], commits[-1:])
+
+
+class PushChunkTest(UploadTestCase):
+    def test_rerun_resumes_from_remote_tip(self):
+        # No state survives a run; the deterministic chain plus ls-remote is what resumes it
+        zip_path = self.make_zip({f"data/part{i}.bin": os.urandom(40000).hex() for i in range(3)})
+        first = self.upload(zip_path, "stream", "-chunked", push_chunk_bytes=100000)
+        self.assertIn("into 3 push chunks", self.output)
+        # Rewind the remote as if the run had died after its second chunk
+        remote = os.path.join(self.root, "stream-chunked", "remote.git")
+        subprocess.run(["git", "update-ref", "refs/heads/main", "main~1"], cwd=remote, check=True)
+        second = self.upload(zip_path, "stream", "-chunked", push_chunk_bytes=100000)
+        self.assertIn("Remote already has 2/3 chunks", self.output)
+        self.assertNotIn("chunk 1/3", self.output)
+        self.assertEqual(first, second)
+
+
+class ExitStatusTest(UploadTestCase):
+
+    def test_failed_batch_job_fails_the_process(self):
+        with open(os.path.join(self.root, "jobs.jsonl"), 'w', encoding='utf-8') as f:
+            f.write('{"zip": "missing.zip", "repo": "missing"}\n')
+        self.assertEqual(self.run_main("--manifest", "jobs.jsonl", "--report", "report.json"), 1)
+
+    def test_failed_upload_fails_the_process(self):
+        self.assertFalse(os.path.exists(b.ZIP_FILE))
+        self.assertEqual(self.run_main(), 1)
+
+
+class LogFormatTest(UploadTestCase):
+    def test_terminal_check_runs_once_per_stream(self):
+        stream = io.StringIO()
+        with mock.patch.object(stream, "isatty", return_value=False) as isatty:
+            logger = b.UploadLogger(level="INFO", fmt="text", stream=stream)
+            for i in range(200):
+                logger.emit("INFO", f"line {i}")
+            logger.flush()
+        self.assertEqual(isatty.call_count, 1)
+        self.assertEqual(len(stream.getvalue().splitlines()), 200)
+
+    def test_json_log_format_keeps_stdout_json_lines(self):
+        self.addCleanup(b.LOGGER.configure, b.LOG_LEVEL, b.LOG_FORMAT, {})
+        self.run_main("--log-format", "json")
+        lines = self.output.splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            self.assertIn('message', json.loads(line))
+
+
+if __name__ == "__main__":
+    unittest.main()